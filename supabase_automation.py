@@ -2,14 +2,23 @@
 import os
 import json
 import base64
+import atexit
 import smtplib
 import datetime
 import csv
+import gzip
+import io
 import sys
 import time
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from supabase import create_client, Client
+import queue
+import threading
+import concurrent.futures
+import functools
+import operator
+import string
+from email.message import EmailMessage
+import httpx
+from supabase import create_client, Client, ClientOptions, PostgrestAPIError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
@@ -17,29 +26,143 @@ from googleapiclient.http import MediaFileUpload
 # Initialize Supabase client
 supabase_url = os.environ.get("SUPABASE_URL")
 supabase_key = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+# One shared HTTP/2 client so every PostgREST call reuses the same keep-alive
+# connection instead of paying a fresh TLS handshake
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+    timeout=30,
+    follow_redirects=True,
+)
+supabase: Client = create_client(
+    supabase_url,
+    supabase_key,
+    options=ClientOptions(httpx_client=http_client),
+)
 
 # Email configuration
 gmail_user = os.environ.get("GMAIL_USER")
 gmail_password = os.environ.get("GMAIL_APP_PASSWORD")
 report_recipient = os.environ.get("REPORT_RECIPIENT")
 
+# Daily report templates, parsed once at import; only substitution happens per run
+report_html_template = string.Template("""
+    <html>
+      <body>
+        <h2>Supabase Daily Report</h2>
+        
+        <h3>Leads Database Report:</h3>
+        <ul>
+          <li>Total Rows: $leads_total</li>
+          <li>New Rows Added Today: $new_leads_today</li>
+        </ul>
+        
+        <h3>Organizations Database Report:</h3>
+        <ul>
+          <li>Total Rows: $orgs_total</li>
+          <li>New Rows Added Today: $new_orgs_today</li>
+        </ul>
+        
+        <p>$totals_note</p>
+        
+        <p>This report was automatically generated at $generated_at UTC.</p>
+      </body>
+    </html>
+    """)
+
+report_text_template = string.Template("""Supabase Daily Report
+
+Leads Database Report:
+  Total Rows: $leads_total
+  New Rows Added Today: $new_leads_today
+
+Organizations Database Report:
+  Total Rows: $orgs_total
+  New Rows Added Today: $new_orgs_today
+
+$totals_note
+
+This report was automatically generated at $generated_at UTC.
+""")
+
+# Report footnote, keyed by whether the totals are planner estimates (None: unknown)
+totals_notes = {
+    True: "Total row counts for large tables are planner estimates and may differ from the exact count by a few percent.",
+    False: "Total row counts are exact.",
+    None: "Total row counts for large tables may be planner estimates, within a few percent of the exact count.",
+}
+
+# Backup configuration: "csv" (gzipped, default) or "parquet" (needs pyarrow)
+backup_format = (os.environ.get("BACKUP_FORMAT") or "csv").lower()
+# Optional direct Postgres connection string; when set, CSV backups use COPY
+database_url = os.environ.get("SUPABASE_DB_URL")
+
+@functools.lru_cache(maxsize=1)
+def get_table_definitions():
+    """
+    Get {table_name: {column: {"type": ..., "format": ...}}} for every table exposed through PostgREST.
+    
+    Reads the OpenAPI description served at /rest/v1/ once per run, so callers
+    can learn a table's columns and their types without issuing a query against
+    the table itself. Returns an empty dict if the schema can't be read, so
+    callers fall back to probing the table directly.
+    """
+    try:
+        response = http_client.get(
+            f"{supabase_url}/rest/v1/",
+            headers={"apikey": supabase_key, "Authorization": f"Bearer {supabase_key}"},
+        )
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Could not read PostgREST schema: {e}")
+        return {}
+    
+    definitions = response.json().get("definitions", {})
+    return {table: spec.get("properties", {}) for table, spec in definitions.items()}
+
+@functools.lru_cache(maxsize=1)
+def get_table_columns():
+    """Get {table_name: [column, ...]} for every table exposed through PostgREST."""
+    return {table: list(properties) for table, properties in get_table_definitions().items()}
+
 def get_total_rows(table_name):
-    """Get total number of rows in a table."""
-    response = supabase.table(table_name).select("count", count="exact").execute()
+    """Get the approximate number of rows in a table.
+
+    Uses count="estimated": PostgREST counts exactly while the table is small
+    and switches to the planner's row estimate once it is large, so the cost
+    stays constant as the table grows. Large-table estimates are typically
+    within a few percent of the true value.
+    """
+    # head=True sends a HEAD request; the count comes back in Content-Range with no body
+    response = supabase.table(table_name).select("*", count="estimated", head=True).execute()
     return response.count
 
-def get_new_rows_today(table_name):
-    """Get count of new rows added today (assuming there's a created_at column)."""
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
+def get_new_rows_today(table_name, today):
+    """Get count of new rows added on or after today, a YYYY-MM-DD date (assuming there's a created_at column)."""
+    columns = get_table_columns().get(table_name)
+    
+    if columns is not None:
+        # The schema tells us which timestamp column exists, so one query is enough
+        if "created_at" in columns:
+            timestamp_column = "created_at"
+        elif "timestamp" in columns:
+            timestamp_column = "timestamp"
+        else:
+            print(f"Warning: Could not find timestamp column in {table_name}. Returning 0.")
+            return 0
+        
+        response = supabase.table(table_name).select("*", count="exact", head=True).gte(timestamp_column, today).execute()
+        return response.count
+    
+    # Without the schema, probe the likely columns in turn
     try:
         # Try with created_at column first
-        response = supabase.table(table_name).select("count", count="exact").gte("created_at", today).execute()
+        response = supabase.table(table_name).select("*", count="exact", head=True).gte("created_at", today).execute()
         return response.count
     except Exception:
         try:
             # Try with a different timestamp column if created_at doesn't exist
-            response = supabase.table(table_name).select("count", count="exact").gte("timestamp", today).execute()
+            response = supabase.table(table_name).select("*", count="exact", head=True).gte("timestamp", today).execute()
             return response.count
         except Exception:
             print(f"Warning: Could not find timestamp column in {table_name}. Returning 0.")
@@ -57,15 +180,15 @@ def get_request_count(table_name):
     """
     try:
         # Approach 1: Try to query PostgreSQL stats views
-        # This SQL query tries to get request statistics from pg_stat_user_tables
-        sql = f"""
-        SELECT n_tup_ins, n_tup_upd, n_tup_del, n_tup_hot_upd, n_live_tup, n_dead_tup, seq_scan, idx_scan  
-        FROM pg_stat_user_tables 
-        WHERE relname = '{table_name}'
-        """
-        
-        # Execute raw SQL through Supabase's RPC call
-        response = supabase.rpc('pg_stat_query', {'query_sql': sql}).execute()
+        # The table name is passed as an RPC argument rather than formatted into
+        # SQL, so it can't inject and Postgres reuses the function's cached plan.
+        # This needs the following function in the database:
+        #
+        #   CREATE OR REPLACE FUNCTION table_stats(relname text)
+        #   RETURNS SETOF pg_stat_user_tables AS $$
+        #     SELECT * FROM pg_stat_user_tables s WHERE s.relname = $1
+        #   $$ LANGUAGE sql STABLE;
+        response = supabase.rpc('table_stats', {'relname': table_name}).execute()
         
         if response.data:
             stats = response.data[0]
@@ -88,168 +211,539 @@ def get_request_count(table_name):
     print(f"Cannot retrieve request count for {table_name}. Consider setting up a tracking system.")
     return "N/A (tracking not available)"
 
+def get_daily_stats(today):
+    """
+    Get (leads_total, orgs_total, new_leads_today, new_orgs_today, totals_estimated) for the daily report.
+    
+    today is the YYYY-MM-DD date that counts as "today" for the new-row counts.
+    totals_estimated says whether either total is a planner estimate, or is
+    None when that can't be told.
+    
+    Tries a single RPC call first so all four numbers come back in one round-trip
+    from the same snapshot. This needs functions like the following in the database:
+    
+        CREATE OR REPLACE FUNCTION table_daily_stats(tbl regclass, today date,
+            OUT total bigint, OUT new_today bigint, OUT estimated boolean) AS $$
+        DECLARE
+          timestamp_column name;
+        BEGIN
+          -- Like count="estimated": the planner's estimate for large tables, an
+          -- exact count below 1000 rows (which includes never-analyzed tables,
+          -- whose reltuples is -1)
+          SELECT reltuples::bigint INTO total FROM pg_class WHERE oid = tbl;
+          estimated := total >= 1000;
+          IF NOT estimated THEN
+            EXECUTE format('SELECT count(*) FROM %s', tbl) INTO total;
+          END IF;
+          
+          -- Same timestamp column choice as get_new_rows_today
+          SELECT attname INTO timestamp_column FROM pg_attribute
+            WHERE attrelid = tbl AND attname IN ('created_at', 'timestamp') AND NOT attisdropped
+            ORDER BY attname <> 'created_at' LIMIT 1;
+          new_today := 0;
+          IF timestamp_column IS NOT NULL THEN
+            EXECUTE format('SELECT count(*) FROM %s WHERE %I >= $1', tbl, timestamp_column)
+              INTO new_today USING today::timestamp AT TIME ZONE 'UTC';
+          END IF;
+        END
+        $$ LANGUAGE plpgsql STABLE;
+        
+        CREATE OR REPLACE FUNCTION daily_stats(today date) RETURNS json AS $$
+          SELECT json_build_object(
+            'leads_total', leads.total,
+            'orgs_total', orgs.total,
+            'new_leads_today', leads.new_today,
+            'new_orgs_today', orgs.new_today,
+            'totals_estimated', leads.estimated OR orgs.estimated
+          )
+          FROM table_daily_stats('leads_db', today) leads, table_daily_stats('orgs_db', today) orgs
+        $$ LANGUAGE sql STABLE;
+    
+    today is passed in rather than read from current_date, which follows the
+    database's time zone instead of the UTC date the report uses.
+    
+    If the functions aren't available, falls back to individual count queries,
+    where large-table totals are estimates (see get_total_rows).
+    """
+    try:
+        response = supabase.rpc('daily_stats', {'today': today}).execute()
+        
+        if response.data:
+            stats = response.data
+            return (
+                stats['leads_total'],
+                stats['orgs_total'],
+                stats['new_leads_today'],
+                stats['new_orgs_today'],
+                stats.get('totals_estimated'),
+            )
+    except Exception as e:
+        print(f"Could not get stats from daily_stats(): {e}")
+    
+    # The count queries are independent, so run them concurrently
+    # and pay roughly one round-trip instead of four
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(get_total_rows, "leads_db"),
+            executor.submit(get_total_rows, "orgs_db"),
+            executor.submit(get_new_rows_today, "leads_db", today),
+            executor.submit(get_new_rows_today, "orgs_db", today),
+        ]
+    # count="estimated" doesn't say whether it estimated
+    return tuple(f.result() for f in futures) + (None,)
+
+@functools.lru_cache(maxsize=1)
+def get_smtp_connection():
+    """Open one authenticated SMTP session and reuse it for every email sent."""
+    # Implicit TLS on 465 saves the STARTTLS round-trip needed on 587
+    server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
+    server.login(gmail_user, gmail_password)
+    
+    def close():
+        try:
+            server.quit()
+        except smtplib.SMTPException:
+            pass
+    
+    atexit.register(close)
+    return server
+
+def send_email(msg):
+    """Send a message over the shared SMTP session, reconnecting once if it has dropped."""
+    try:
+        get_smtp_connection().send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # The server closed the idle session; open a fresh one and retry
+        get_smtp_connection.cache_clear()
+        get_smtp_connection().send_message(msg)
+
 def send_daily_report():
     """Generate and send daily report via email."""
+    # Read the clock once, in UTC, so every query and label in the report
+    # agrees on what "today" is even if the run straddles midnight
+    now = datetime.datetime.now(datetime.timezone.utc)
+    today = now.strftime('%Y-%m-%d')
+    
     # Get basic stats
-    leads_total = get_total_rows("leads_db")
-    orgs_total = get_total_rows("orgs_db")
-    new_leads_today = get_new_rows_today("leads_db")
-    new_orgs_today = get_new_rows_today("orgs_db")
+    leads_total, orgs_total, new_leads_today, new_orgs_today, totals_estimated = get_daily_stats(today)
+    
+    stats = {
+        "leads_total": leads_total,
+        "orgs_total": orgs_total,
+        "new_leads_today": new_leads_today,
+        "new_orgs_today": new_orgs_today,
+        "totals_note": totals_notes[totals_estimated],
+        "generated_at": now.strftime('%Y-%m-%d %H:%M:%S'),
+    }
     
     # Create email
-    msg = MIMEMultipart()
+    msg = EmailMessage()
     msg["From"] = gmail_user
     msg["To"] = report_recipient
-    msg["Subject"] = f"Supabase Daily Report - {datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    body = f"""
-    <html>
-      <body>
-        <h2>Supabase Daily Report</h2>
-        
-        <h3>Leads Database Report:</h3>
-        <ul>
-          <li>Total Rows: {leads_total}</li>
-          <li>New Rows Added Today: {new_leads_today}</li>
-        </ul>
-        
-        <h3>Organizations Database Report:</h3>
-        <ul>
-          <li>Total Rows: {orgs_total}</li>
-          <li>New Rows Added Today: {new_orgs_today}</li>
-        </ul>
-        
-        <p>This report was automatically generated at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} UTC.</p>
-      </body>
-    </html>
-    """
-    
-    msg.attach(MIMEText(body, "html"))
+    msg["Subject"] = f"Supabase Daily Report - {today}"
+    msg.set_content(report_text_template.substitute(stats))
+    msg.add_alternative(report_html_template.substitute(stats), subtype="html")
     
     # Send email
     try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(gmail_user, gmail_password)
-        server.send_message(msg)
-        server.quit()
+        send_email(msg)
         print("Daily report email sent successfully!")
     except Exception as e:
         print(f"Failed to send email: {e}")
 
-def export_database_paginated(table_name):
-    """Export database table to CSV using aggressive pagination to avoid timeouts."""
-    filename = f"{table_name}_{datetime.datetime.now().strftime('%Y-%m-%d')}.csv"
+def is_transient_error(e):
+    """Return True if a failed query is worth retrying (rate limiting, server or network trouble)."""
+    # Timeouts are TransportErrors too
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, PostgrestAPIError):
+        # postgrest-py reports non-JSON error responses with the HTTP status as
+        # the code; PGRST000-PGRST003 are PostgREST's own 503/504 answers when
+        # it can't reach the database or its connection pool is exhausted
+        code = str(e.code)
+        return code == "429" or (len(code) == 3 and code.startswith("5")) or code in ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+    return False
+
+def execute_with_backoff(query, attempts=5):
+    """
+    Execute a query, retrying transient failures with exponential backoff
+    (1s, 2s, 4s, 8s). Anything else, like an unknown column or a bad key, is
+    raised at once, as is the last error once all attempts have failed.
+    """
+    for attempt in range(attempts):
+        try:
+            return query.execute()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_transient_error(e):
+                raise
+            delay = 2 ** attempt
+            print(f"Query failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+def fetch_pages(table_name, headers, id_field, page_size, total_count):
+    """
+    Yield successive pages of rows from a table using keyset pagination on id_field.
     
-    # First, try to get columns via a single row
-    try:
-        print(f"Determining structure of {table_name}...")
+    id_field should be indexed (the primary key normally is); otherwise every
+    page's id > last_id filter turns into a sequential scan.
+    """
+    page = 0
+    rows_exported = 0
+    
+    # Use keyset pagination (id > last_id) instead of offset pagination so
+    # every page costs the same no matter how deep into the table we are
+    last_id = None
+    
+    while True:
+        print(f"Fetching batch {page} of {table_name} (rows {rows_exported}/{total_count})...")
         
-        # Try to get column names from a single row
-        first_row = supabase.table(table_name).select("*").limit(1).execute()
+        # Build query, asking only for the columns we export
+        query = supabase.table(table_name).select(*headers).limit(page_size)
         
-        if not first_row.data:
-            print(f"Warning: No data found in table {table_name}")
-            # Create empty file with just headers
-            with open(filename, "w", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(["id"])  # Minimal header
-            return filename
+        # Add cursor condition if we have a last_id
+        if last_id is not None:
+            query = query.gt(id_field, last_id)
         
-        headers = list(first_row.data[0].keys())
+        # Order by the id field for consistent pagination
+        query = query.order(id_field, desc=False)
         
-        # Get total count for progress tracking
-        total_count = get_total_rows(table_name)
-        print(f"Total rows to export from {table_name}: {total_count}")
+        try:
+            # Transient failures are retried against the same cursor, so no
+            # rows are skipped
+            rows = execute_with_backoff(query).data
+        except Exception as e:
+            # Retries are exhausted or the error isn't transient; stop rather
+            # than guess at a cursor. The caller keeps what has been written
+            # so far as a _PARTIAL backup.
+            print(f"Error fetching batch {page}: {e}")
+            if last_id is not None:
+                print(f"Export of {table_name} stopped after {id_field} {last_id} ({rows_exported} rows)")
+            raise
         
-        # Open file and write headers
-        with open(filename, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(headers)
-            
-            # Use very small page size for aggressive pagination
-            page_size = 100  # Significantly reduced from 500
-            page = 0
-            rows_exported = 0
-            more_data = True
+        # Only an empty page ends the export. PostgREST silently caps every
+        # response at the project's max rows setting, so a page shorter than
+        # page_size doesn't mean the table is exhausted.
+        if not rows:
+            print("No more data found.")
+            break
+        
+        # Keep track of the last ID for cursor pagination
+        last_id = rows[-1].get(id_field)
+        
+        # Update counters
+        rows_exported += len(rows)
+        page += 1
+        
+        yield rows
+        
+        # Release this page before fetching the next one
+        del rows
+        
+        # Progress update
+        # The total is an estimate, so never report more than 100%
+        progress_percent = (rows_exported / max(total_count, rows_exported)) * 100
+        print(f"Progress: {rows_exported}/{total_count} rows ({progress_percent:.1f}%)")
+
+def prefetch(pages, depth=2):
+    """
+    Yield pages from an iterator while a background thread fetches the next ones.
+    
+    Up to depth pages are buffered, so the network round-trip for the next page
+    overlaps with writing the current one. Errors raised while fetching are
+    re-raised in the consuming thread. If the consumer stops early (a write
+    error, or the generator is closed), the producer stops fetching and closes
+    pages instead of blocking forever on a full buffer.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    
+    def put(item):
+        # Wait for room in the buffer, but give up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((None, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            # Close the generator from the thread that runs it
+            pages.close()
+    
+    # Daemon thread, so an abandoned export can't keep the process alive
+    threading.Thread(target=produce, daemon=True).start()
+    
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is None:
+                return
+            yield page
+    finally:
+        stop.set()
+
+def copy_value(value):
+    """Render a value from PostgREST's JSON the way COPY writes it to CSV."""
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def copy_array(value):
+    """Render a Postgres array, which PostgREST returns as a JSON list, as an array literal."""
+    if value is None:
+        return None
+    elements = []
+    for element in value:
+        if element is None:
+            elements.append("NULL")
+        elif isinstance(element, list):
+            elements.append(copy_array(element))
+        else:
+            text = str(copy_value(element))
+            elements.append('"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+def write_csv(filename, headers, pages, properties=None):
+    """
+    Write pages of rows to a gzipped CSV file. Returns the number of rows written.
+    
+    Values are written the way export_database_copy's COPY writes them
+    (booleans as t/f, json/jsonb as JSON text, arrays as Postgres array
+    literals), so a backup reads the same whichever path produced it.
+    properties is the table's PostgREST column description (see
+    get_table_definitions); with it only the columns that need converting are
+    touched. Without it every value is checked, and arrays, which can't be
+    told apart from JSON, are written as JSON text.
+    """
+    rows_written = 0
+    
+    if properties:
+        converters = []
+        for index, header in enumerate(headers):
+            column_type = properties.get(header, {}).get("type")
+            if column_type == "array":
+                converters.append((index, copy_array))
+            elif column_type not in ("string", "integer", "number"):
+                # boolean, json and jsonb
+                converters.append((index, copy_value))
+    else:
+        converters = None
+    
+    def convert_row(values):
+        values = list(values)
+        for index, convert in converters:
+            values[index] = convert(values[index])
+        return values
+    
+    # Open file once, compressing on the fly, and write headers. The 1 MB
+    # buffer hands the compressor large blocks instead of one per 8 KB of text.
+    with gzip.open(filename, "wb", compresslevel=3) as compressed, \
+            io.BufferedWriter(compressed, buffer_size=1 << 20) as buffered, \
+            io.TextIOWrapper(buffered, encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        
+        # Project rows to header order with a C-level itemgetter. PostgREST
+        # returns every selected column on every row (nulls as None, which
+        # csv writes as empty), so no per-key .get() fallback is needed.
+        row_values = operator.itemgetter(*headers)
+        if len(headers) == 1:
+            # A single-key itemgetter returns a bare value, not a tuple
+            single_value = row_values
+            row_values = lambda row: (single_value(row),)
+        
+        for rows in pages:
+            # Write this batch of rows in one call, keeping values in header order
+            values = map(row_values, rows)
+            if converters is None:
+                values = (map(copy_value, row) for row in values)
+            elif converters:
+                values = map(convert_row, values)
+            writer.writerows(values)
+            rows_written += len(rows)
+    
+    return rows_written
+
+def write_parquet(filename, headers, pages, properties=None):
+    """
+    Write pages of rows to a Snappy-compressed Parquet file. Returns the number of rows written.
+    
+    properties is the table's PostgREST column description (see
+    get_table_definitions); without it, column types are taken from the first
+    page. json/jsonb and array columns are stored as JSON text. A value that
+    doesn't fit its column's type raises instead of being cast, and the file is
+    removed, since a backup with silently altered values can't be trusted.
+    """
+    # pyarrow is only needed for Parquet backups, so import it here
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    arrow_types = {"integer": pa.int64(), "number": pa.float64(), "boolean": pa.bool_(), "string": pa.string()}
+    
+    if properties:
+        # Columns with no scalar OpenAPI type (json, jsonb, arrays) become JSON text
+        column_types = {header: properties.get(header, {}).get("type") for header in headers}
+        json_columns = [header for header, column_type in column_types.items() if column_type not in arrow_types]
+        schema = pa.schema([(header, arrow_types.get(column_type, pa.string())) for header, column_type in column_types.items()])
+    else:
+        json_columns = []
+        schema = None
+    
+    rows_written = 0
+    writer = None
+    
+    try:
+        for rows in pages:
+            if schema is None:
+                # No table definition: infer types from the first page. Nested
+                # values are JSON, and columns that are all null there have no
+                # type yet, so both are stored as strings
+                inferred = pa.Table.from_pylist(rows).select(headers).schema
+                json_columns = [field.name for field in inferred if pa.types.is_nested(field.type)]
+                schema = pa.schema([
+                    pa.field(field.name, pa.string())
+                    if pa.types.is_null(field.type) or field.name in json_columns else field
+                    for field in inferred
+                ])
             
-            print(f"Exporting {table_name} with aggressive pagination (page size: {page_size})...")
+            for row in rows:
+                for column in json_columns:
+                    if row[column] is not None:
+                        row[column] = json.dumps(row[column])
             
-            # Try to find a primary key or id field
-            id_field = "id"  # Default
-            if "id" not in headers:
-                # Look for other common primary key names
-                for possible_id in ["uuid", "primary_key", "key", headers[0]]:
-                    if possible_id in headers:
-                        id_field = possible_id
-                        break
+            if writer is None:
+                writer = pq.ParquetWriter(filename, schema, compression="snappy")
             
-            print(f"Using {id_field} as primary key for pagination")
+            # Let pyarrow infer the page's own types, then cast safely: unlike
+            # from_pylist(schema=...), a cast refuses to truncate 2.5 to 2
+            table = pa.Table.from_pylist(rows).select(headers).cast(schema)
+            writer.write_table(table)
+            rows_written += len(rows)
+        
+        if writer is None:
+            # Empty table: write a file with just the column names
+            writer = pq.ParquetWriter(filename, schema or pa.schema([(header, pa.string()) for header in headers]), compression="snappy")
+    except pa.ArrowException:
+        # Don't leave a mistyped file behind to be kept as a _PARTIAL backup
+        if writer is not None:
+            writer.close()
+            writer = None
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    return rows_written
+
+def export_database_copy(table_name, filename):
+    """Stream a table to gzipped CSV with COPY over a direct Postgres connection."""
+    # psycopg is only needed when a direct database URL is configured
+    import psycopg
+    from psycopg import sql
+    
+    query = sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(table_name))
+    
+    # The server produces the CSV itself, so rows never go through JSON or
+    # pagination; chunks are compressed and written as they arrive
+    # prepare_threshold=None disables server-side prepared statements, which
+    # Supabase's transaction-mode pooler (Supavisor) doesn't support
+    with psycopg.connect(database_url, prepare_threshold=None) as conn, conn.cursor() as cur:
+        with gzip.open(filename, "wb", compresslevel=3) as f, cur.copy(query) as copy:
+            for data in copy:
+                f.write(data)
+
+def export_database_paginated(table_name):
+    """
+    Export database table page by page to avoid timeouts.
+    
+    Writes gzipped CSV by default, or Parquet when BACKUP_FORMAT=parquet. CSV
+    backups use a server-side COPY instead when SUPABASE_DB_URL is set.
+    """
+    extension = ".parquet" if backup_format == "parquet" else ".csv.gz"
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    filename = f"{table_name}_{today}{extension}"
+    write_pages = write_parquet if backup_format == "parquet" else write_csv
+    
+    # With a direct database connection, let Postgres stream the whole table
+    if database_url and backup_format == "csv":
+        try:
+            print(f"Exporting {table_name} with COPY...")
+            export_database_copy(table_name, filename)
+            print(f"Exported {table_name} with COPY successfully!")
+            return filename
+        except Exception as e:
+            print(f"COPY export of {table_name} failed, falling back to pagination: {e}")
+    
+    # First, work out the table's columns
+    try:
+        print(f"Determining structure of {table_name}...")
+        
+        # Use the cached PostgREST schema so no probe query is needed
+        headers = get_table_columns().get(table_name)
+        
+        if not headers:
+            # Fall back to getting column names from a single row
+            first_row = supabase.table(table_name).select("*").limit(1).execute()
             
-            # Use cursor-based pagination instead of offset pagination
-            last_id = None
+            if not first_row.data:
+                print(f"Warning: No data found in table {table_name}")
+                # Create empty file with just headers
+                write_pages(filename, ["id"], [])  # Minimal header
+                return filename
             
-            while more_data and rows_exported < total_count:
-                try:
-                    print(f"Fetching batch {page} of {table_name} (rows {rows_exported}/{total_count})...")
-                    
-                    # Build query
-                    query = supabase.table(table_name).select("*").limit(page_size)
-                    
-                    # Add cursor condition if we have a last_id
-                    if last_id is not None:
-                        query = query.gt(id_field, last_id)
-                    
-                    # Order by the id field for consistent pagination
-                    query = query.order(id_field, desc=False)
-                    
-                    # Execute with timeout handling
-                    response = query.execute()
-                    
-                    rows = response.data
-                    if not rows:
-                        more_data = False
-                        print("No more data found.")
-                    else:
-                        # Write this batch of rows
-                        for row in rows:
-                            # Ensure all values are in the same order as headers
-                            row_values = [row.get(header, "") for header in headers]
-                            writer.writerow(row_values)
-                        
-                        # Keep track of the last ID for cursor pagination
-                        last_id = rows[-1].get(id_field)
-                        
-                        # Update counters
-                        rows_exported += len(rows)
-                        page += 1
-                        
-                        # Progress update
-                        progress_percent = (rows_exported / total_count) * 100
-                        print(f"Progress: {rows_exported}/{total_count} rows ({progress_percent:.1f}%)")
-                        
-                        # Add a small delay between requests to reduce database load
-                        if more_data:
-                            print("Pausing briefly to avoid database overload...")
-                            time.sleep(1)  # 1 second delay between batches
-                
-                except Exception as e:
-                    # If an individual batch fails, log it but continue with the next one
-                    print(f"Error fetching batch {page}: {e}")
-                    
-                    # If we've already got some data, try to continue with the next batch
-                    if rows_exported > 0:
-                        page += 1
-                        if last_id is not None:
-                            print(f"Continuing from ID: {last_id}")
-                        else:
-                            # Without a valid cursor, we need to skip ahead
-                            # This is not ideal but at least gets some data
-                            last_id = f"approximate_batch_{page}"
-                            print(f"Cannot continue properly, attempting to skip ahead.")
-                    else:
-                        # If we haven't got any data yet, this is a fatal error
-                        raise
+            headers = list(first_row.data[0].keys())
+        
+        # Get an estimated total for progress tracking only
+        total_count = get_total_rows(table_name)
+        print(f"Estimated rows to export from {table_name}: {total_count}")
+        
+        # Keyset pages cost the same at any depth, so ask for Supabase's default
+        # max rows (1000) and make 10x fewer round-trips than 100-row pages.
+        # A project with a lower max rows setting gets shorter pages back;
+        # fetch_pages keeps going until an empty page, so no rows are lost.
+        page_size = 1000
+        
+        print(f"Exporting {table_name} with keyset pagination (page size: {page_size})...")
+        
+        # Try to find a primary key or id field
+        id_field = "id"  # Default
+        if "id" not in headers:
+            # Look for other common primary key names
+            for possible_id in ["uuid", "primary_key", "key", headers[0]]:
+                if possible_id in headers:
+                    id_field = possible_id
+                    break
+        
+        print(f"Using {id_field} as primary key for pagination")
+        
+        # The table definition types the Parquet columns, and tells write_csv
+        # which columns to render the way COPY does
+        write_pages = functools.partial(write_pages, properties=get_table_definitions().get(table_name))
+        
+        # Fetch the next page in the background while the current one is written
+        pages = prefetch(fetch_pages(table_name, headers, id_field, page_size, total_count))
+        try:
+            rows_exported = write_pages(filename, headers, pages)
+        finally:
+            # Stop the background fetch right away if writing failed
+            pages.close()
         
         print(f"Exported {rows_exported} rows from {table_name} successfully!")
         return filename
@@ -259,35 +753,61 @@ def export_database_paginated(table_name):
         
         # If we have a partial file, note that in the filename
         if os.path.exists(filename):
-            partial_filename = f"{table_name}_{datetime.datetime.now().strftime('%Y-%m-%d')}_PARTIAL.csv"
+            partial_filename = f"{table_name}_{today}_PARTIAL{extension}"
             os.rename(filename, partial_filename)
             print(f"Saved partial data to {partial_filename}")
             return partial_filename
             
         raise
 
-def upload_to_drive(filename, folder_id=None):
-    """Upload file to Google Drive."""
-    # Decode and save credentials
+@functools.lru_cache(maxsize=1)
+def get_drive_service():
+    """Build the Google Drive client once and reuse it for every upload."""
+    # Decode credentials straight into memory; nothing is written to disk
     credentials_json = base64.b64decode(os.environ.get("GOOGLE_DRIVE_CREDENTIALS")).decode('utf-8')
     credentials_dict = json.loads(credentials_json)
     
-    with open('credentials.json', 'w') as f:
-        json.dump(credentials_dict, f)
-    
-    credentials = service_account.Credentials.from_service_account_file(
-        'credentials.json', 
+    credentials = service_account.Credentials.from_service_account_info(
+        credentials_dict,
+        # Full drive scope: uploads go into GOOGLE_DRIVE_FOLDER_ID, a folder shared
+        # with the service account, which drive.file would not let it see
         scopes=['https://www.googleapis.com/auth/drive']
     )
     
-    drive_service = build('drive', 'v3', credentials=credentials)
+    # Use the discovery document bundled with googleapiclient instead of
+    # fetching it over HTTPS, and skip the file-based discovery cache lookup
+    return build(
+        'drive', 'v3',
+        credentials=credentials,
+        static_discovery=True,
+        cache_discovery=False
+    )
+
+def upload_to_drive(filename, folder_id=None):
+    """Upload file to Google Drive."""
+    drive_service = get_drive_service()
     
     file_metadata = {
         'name': filename,
         'parents': [folder_id] if folder_id else []
     }
     
-    media = MediaFileUpload(filename, resumable=True)
+    if filename.endswith(".parquet"):
+        mimetype = "application/vnd.apache.parquet"
+    else:
+        mimetype = "application/gzip"
+    
+    # Small files go up in a single multipart request; only larger ones are
+    # worth the extra round-trip of opening a resumable session, and those
+    # are sent in 8 MB chunks rather than the library's 100 MB default
+    resumable = os.path.getsize(filename) > 5 * 1024 * 1024
+    
+    media = MediaFileUpload(
+        filename,
+        mimetype=mimetype,
+        resumable=resumable,
+        chunksize=8 * 1024 * 1024
+    )
     
     file = drive_service.files().create(
         body=file_metadata,
@@ -298,7 +818,6 @@ def upload_to_drive(filename, folder_id=None):
     print(f"File {filename} uploaded to Google Drive with ID: {file.get('id')}")
     
     # Clean up
-    os.remove('credentials.json')
     os.remove(filename)
 
 def weekly_backup():
@@ -309,20 +828,29 @@ def weekly_backup():
     folder_id = os.environ.get("GOOGLE_DRIVE_FOLDER_ID")
     
     try:
-        print("Exporting leads_db...")
-        leads_file = export_database_paginated("leads_db")
-        print(f"Successfully exported leads_db to {leads_file}")
-        
-        print("Exporting orgs_db...")
-        orgs_file = export_database_paginated("orgs_db")
-        print(f"Successfully exported orgs_db to {orgs_file}")
-        
-        # Upload to Google Drive with the specified folder ID
-        print("Uploading leads_db to Google Drive...")
-        upload_to_drive(leads_file, folder_id)
-        
-        print("Uploading orgs_db to Google Drive...")
-        upload_to_drive(orgs_file, folder_id)
+        # Exports wait on Supabase and uploads wait on Drive, so overlap them:
+        # both tables export at once and each file starts uploading as soon as
+        # it is ready. Uploads stay on a single worker because the shared Drive
+        # client (httplib2 underneath) is not thread-safe.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as exporter, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as uploader:
+            exports = {}
+            for table_name in ["leads_db", "orgs_db"]:
+                print(f"Exporting {table_name}...")
+                exports[exporter.submit(export_database_paginated, table_name)] = table_name
+            
+            uploads = []
+            for export in concurrent.futures.as_completed(exports):
+                table_name = exports[export]
+                filename = export.result()
+                print(f"Successfully exported {table_name} to {filename}")
+                
+                # Upload to Google Drive with the specified folder ID
+                print(f"Uploading {table_name} to Google Drive...")
+                uploads.append(uploader.submit(upload_to_drive, filename, folder_id))
+            
+            for upload in uploads:
+                upload.result()
         
         print("Weekly backup completed successfully!")
     except Exception as e: